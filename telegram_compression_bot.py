@@ -1,51 +1,177 @@
+import atexit
 import os
 import logging
+import queue
+import shutil
+import signal
 import tempfile
 import time
-from typing import Dict, Any, Optional
+from asyncio.subprocess import Process
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+from uuid import uuid4
 import asyncio
-from functools import partial
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import aiofiles
+import aiohttp
+from telegram import Bot, File, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes, filters
-import ffmpeg
 
-# Configure logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+try:
+    from pyrogram import Client as PyrogramClient
+except ImportError:
+    PyrogramClient = None
+
+# Configure logging; main() moves the handlers behind a queue
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_FILE = "bot.log"
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Configuration
 TOKEN = "YOUR_TELEGRAM_BOT_TOKEN"
+# MTProto credentials from my.telegram.org; leave unset to transfer files
+# through the Bot API only (20MB downloads, 50MB uploads)
+API_ID = 0
+API_HASH = ""
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB for regular users
 PREMIUM_MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB for premium users
+BOT_API_UPLOAD_LIMIT = 50 * 1024 * 1024  # Largest file the Bot API accepts for upload
 TEMP_DOWNLOAD_DIR = os.path.join(tempfile.gettempdir(), "tg_video_compressor")
 os.makedirs(TEMP_DOWNLOAD_DIR, exist_ok=True)
 
-# Track active compression tasks
-active_tasks: Dict[int, Dict[str, Any]] = {}
+# RAM-backed directory preferred for job files, see reserve_job_dir()
+SHM_DIR = "/dev/shm"
+SHM_JOB_DIR = os.path.join(SHM_DIR, "tg_video_compressor")
+if os.path.isdir(SHM_DIR):
+    os.makedirs(SHM_JOB_DIR, exist_ok=True)
+
+# Bytes of /dev/shm promised to running jobs that may not be written yet
+_shm_reserved = 0
+
+# MTProto client for file transfers, started in post_init() when configured
+pyro_client = None
+
+
+@dataclass(slots=True, eq=False)
+class Task:
+    """State of one user's compression job."""
+    video_info: Dict[str, Any]
+    quality: str
+    codec: str
+    status_message_id: int
+    start_time: float
+    canceled: bool = False
+    proc: Optional[Process] = None
+
+
+# Track active compression tasks per user; jobs beyond the encoder capacity
+# wait in the ffmpeg worker pool's queue
+active_tasks: Dict[int, List[Task]] = {}
 
 # Compression presets
+# "crf" doubles as the hardware quality target (NVENC -cq, QSV -global_quality,
+# VAAPI -qp); "nvenc_preset" mirrors the x264 speed preset on the NVENC
+# p1 (fastest) .. p7 (slowest) scale.
 COMPRESSION_PRESETS = {
     "low": {
         "crf": 28,
         "preset": "veryfast",
+        "nvenc_preset": "p1",
         "description": "Small file size, lower quality"
     },
     "medium": {
         "crf": 23,
         "preset": "medium",
+        "nvenc_preset": "p4",
         "description": "Balanced file size and quality"
     },
     "high": {
         "crf": 18,
         "preset": "slow",
+        "nvenc_preset": "p6",
         "description": "Larger file size, higher quality"
     }
 }
 
+# Render node used by the VAAPI and QSV encoders
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# Containers ffmpeg can demux from a non-seekable pipe. MP4/MOV are left out
+# because their moov atom may sit at the end of the file and needs a seek.
+STREAMABLE_MIME_TYPES = {"video/x-matroska", "video/webm", "video/x-flv", "video/mp2t"}
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1MB per write into ffmpeg's stdin
+# Downloads get no total time limit (a piped one only moves as fast as ffmpeg
+# encodes); a socket that stays silent this long is treated as stalled
+STREAM_READ_TIMEOUT = 600
+FILE_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB per write when downloading to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB per read when uploading from disk
+# How long Telegram may take to answer once an upload has been sent
+UPLOAD_READ_TIMEOUT = 300
+
+# Concurrent NVENC sessions per GPU; consumer cards cap how many can be open
+MAX_CONCURRENT_NVENC = 4
+
+# Runs every ffmpeg job; started in post_init() once the encoder is known
+ffmpeg_pool: Optional["FfmpegWorkerPool"] = None
+
+# NVIDIA GPUs found by probe_gpus(), and the ffmpeg jobs running on each
+NVIDIA_GPU_COUNT = 1
+_gpu_jobs: List[int] = [0]
+
+# ffmpeg options per (quality, encoder, codec), split into the arguments that
+# go before and after "-i"; filled in once at startup by build_argv_table()
+PRECOMPUTED_ARGV: Dict[Tuple[str, str, str], Tuple[Tuple[str, ...], Tuple[str, ...]]] = {}
+
+# Output codecs users can pick in /settings
+CODEC_LABELS = {"h264": "H.264", "hevc": "HEVC"}
+
+# Hardware encoder backends in order of preference
+HARDWARE_BACKENDS = ("nvenc", "qsv", "vaapi")
+
+# ffmpeg encoder name per (backend, codec)
+ENCODER_NAMES = {
+    ("nvenc", "h264"): "h264_nvenc",
+    ("nvenc", "hevc"): "hevc_nvenc",
+    ("qsv", "h264"): "h264_qsv",
+    ("qsv", "hevc"): "hevc_qsv",
+    ("vaapi", "h264"): "h264_vaapi",
+    ("vaapi", "hevc"): "hevc_vaapi",
+    ("software", "h264"): "libx264",
+    ("software", "hevc"): "libx265",
+}
+
+# NVDEC decoders by source codec name, as reported by ffprobe
+NVDEC_DECODERS = {
+    "h264": "h264_cuvid",
+    "hevc": "hevc_cuvid",
+    "av1": "av1_cuvid",
+    "vp8": "vp8_cuvid",
+    "vp9": "vp9_cuvid",
+    "mpeg2video": "mpeg2_cuvid",
+    "mpeg4": "mpeg4_cuvid",
+    "vc1": "vc1_cuvid",
+    "mjpeg": "mjpeg_cuvid",
+}
+
+# Source pixel formats NVDEC can decode and NVENC can encode without a
+# conversion; h264_nvenc only takes 8-bit 4:2:0, hevc_nvenc also 10-bit
+NVENC_PIX_FMTS = {
+    "h264": {"yuv420p", "yuvj420p", "nv12"},
+    "hevc": {"yuv420p", "yuvj420p", "nv12", "yuv420p10le", "p010le"},
+}
+# 10-bit 4:2:0 sources NVDEC can decode and scale_cuda can bring down to 8-bit
+NVDEC_10BIT_PIX_FMTS = {"yuv420p10le", "p010le"}
+
+# Usable ffmpeg encoders and available decoders, filled in once at startup
+# by probe_codecs()
+AVAILABLE_ENCODERS: FrozenSet[str] = frozenset()
+AVAILABLE_DECODERS: FrozenSet[str] = frozenset()
+
 # Help messages
 WELCOME_MESSAGE = """
 👋 Welcome to Video Compressor Bot!
@@ -80,10 +206,14 @@ HELP_MESSAGE = """
 • *Medium:* Balanced quality and size - recommended for most videos
 • *High:* Higher quality, larger file size - best for important videos
 
+*Codec Settings:*
+• *H.264:* Plays on every device
+• *HEVC:* 30-50% smaller files at the same quality - may not play on older devices
+
 *Commands:*
 /start - Show welcome message
 /help - Show this help message
-/settings - Set your default compression quality
+/settings - Set your default compression quality and codec
 /cancel - Cancel the current compression task
 
 *File Size Limits:*
@@ -102,9 +232,10 @@ MP4, MOV, AVI, MKV, WEBM, FLV
 SETTINGS_MESSAGE = """
 *⚙️ Compression Settings*
 
-Choose your default compression quality:
+Choose your default compression quality and video codec:
 
 *Current default:* {default_quality}
+*Current codec:* {default_codec}
 
 Select an option below to change:
 """
@@ -127,7 +258,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /settings command to set default quality."""
+    """Handle the /settings command to set default quality and codec."""
     user_id = update.effective_user.id
     
     # Get current default quality from user data or set to medium
@@ -138,12 +269,19 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             InlineKeyboardButton("🔄 Low", callback_data="set_default_low"),
             InlineKeyboardButton("🔄 Medium", callback_data="set_default_medium"),
             InlineKeyboardButton("🔄 High", callback_data="set_default_high"),
+        ],
+        [
+            InlineKeyboardButton("🎞 H.264", callback_data="set_codec_h264"),
+            InlineKeyboardButton("🎞 HEVC", callback_data="set_codec_hevc"),
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(
-        SETTINGS_MESSAGE.format(default_quality=default_quality.capitalize()),
+        SETTINGS_MESSAGE.format(
+            default_quality=default_quality.capitalize(),
+            default_codec=CODEC_LABELS[get_default_codec(context)]
+        ),
         reply_markup=reply_markup,
         parse_mode="Markdown"
     )
@@ -167,15 +305,43 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
     )
 
 
+def get_default_codec(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Return the user's codec choice; premium users default to the smaller HEVC."""
+    is_premium = context.user_data.get("is_premium", False)
+    return context.user_data.get("default_codec", "hevc" if is_premium else "h264")
+
+
+async def handle_codec_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle codec settings callback queries."""
+    query = update.callback_query
+    await query.answer()
+    
+    # Extract the codec from callback data
+    codec = query.data.replace("set_codec_", "")
+    
+    # Save user preference
+    context.user_data["default_codec"] = codec
+    
+    await query.edit_message_text(
+        f"✅ Default video codec set to: *{CODEC_LABELS[codec]}*\n\n"
+        f"HEVC files are 30-50% smaller at the same quality but may not play on older devices.",
+        parse_mode="Markdown"
+    )
+
+
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Cancel the current compression task."""
+    """Cancel the user's running and queued compression tasks."""
     user_id = update.effective_user.id
     
     if user_id in active_tasks:
-        # Mark as canceled in the task dict
-        active_tasks[user_id]["canceled"] = True
+        # Mark each task as canceled and stop any running ffmpeg
+        for task_info in active_tasks[user_id]:
+            task_info.canceled = True
+            proc = task_info.proc
+            if proc is not None and proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
         await update.message.reply_text(
-            "⚠️ Canceling your compression task. Please wait...",
+            "⚠️ Canceling your compression tasks. Please wait...",
             parse_mode="Markdown"
         )
     else:
@@ -187,15 +353,6 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle video files sent by users."""
-    user_id = update.effective_user.id
-    
-    # Check if user already has an active compression task
-    if user_id in active_tasks:
-        await update.message.reply_text(
-            "⚠️ You already have an active compression task. Please wait for it to complete or use /cancel."
-        )
-        return
-    
     # Get the video file
     video = update.message.video or update.message.document
     
@@ -210,7 +367,8 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     # Check if user is premium (this is just a placeholder - implement actual check)
     is_premium = context.user_data.get("is_premium", False)
-    size_limit = PREMIUM_MAX_FILE_SIZE if is_premium else MAX_FILE_SIZE
+    # Downloads over MTProto aren't bound by the Bot API cap
+    size_limit = PREMIUM_MAX_FILE_SIZE if is_premium or pyro_client is not None else MAX_FILE_SIZE
     
     if file_size > size_limit:
         await update.message.reply_text(
@@ -257,199 +415,718 @@ async def handle_compression_callback(update: Update, context: ContextTypes.DEFA
     quality = query.data.replace("compress_", "")
     
     # Get pending video info
-    video_info = context.user_data.get("pending_video")
+    # Pop it so a second tap on the same keyboard can't start a duplicate job
+    video_info = context.user_data.pop("pending_video", None)
     if not video_info:
         await query.edit_message_text(
             "❌ No pending video found. Please send a video file again."
         )
         return
     
+    # Use the user's codec if this host can encode it
+    codec = resolve_codec(get_default_codec(context))
+    
     # Update message with compression status
     status_message = await query.edit_message_text(
         f"⚙️ Starting compression with *{quality.capitalize()}* quality preset...\n\n"
+        f"Codec: {CODEC_LABELS[codec]}\n"
         f"Original size: {video_info['file_size']/(1024*1024):.1f}MB\n"
         f"Please wait, this may take some time depending on the video size.",
         parse_mode="Markdown"
     )
     
     # Create task entry
-    active_tasks[user_id] = {
-        "video_info": video_info,
-        "quality": quality,
-        "status_message_id": status_message.message_id,
-        "start_time": time.time(),
-        "canceled": False
-    }
+    task_info = Task(
+        video_info=video_info,
+        quality=quality,
+        codec=codec,
+        status_message_id=status_message.message_id,
+        start_time=time.time()
+    )
+    active_tasks.setdefault(user_id, []).append(task_info)
     
     # Start compression in background
-    asyncio.create_task(process_compression(update, context, user_id))
+    asyncio.create_task(process_compression(update, context, user_id, task_info))
+
+
+class StatusUpdater:
+    """Coalesce edits to a status message so at most one request is in flight."""
+    
+    def __init__(self, bot: Bot, chat_id: int, message_id: int) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.latest: Optional[Tuple[str, Optional[str]]] = None
+        self.inflight: Optional[asyncio.Task] = None
+    
+    def set(self, text: str, parse_mode: Optional[str] = None) -> None:
+        """Show text next, replacing any update that hasn't been sent yet."""
+        self.latest = (text, parse_mode)
+        if self.inflight is None or self.inflight.done():
+            self.inflight = asyncio.create_task(self._send())
+    
+    async def _send(self) -> None:
+        """Send the latest text, then again if it changed while in flight."""
+        while self.latest is not None:
+            text, parse_mode = self.latest
+            self.latest = None
+            try:
+                await self.bot.edit_message_text(
+                    text,
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    parse_mode=parse_mode
+                )
+            except TelegramError as e:
+                logger.warning(f"Failed to update status message: {e}")
+    
+    async def flush(self) -> None:
+        """Wait until the latest text has been sent."""
+        if self.inflight is not None:
+            await self.inflight
+
+
+def reserve_job_dir(nbytes: int) -> str:
+    """Pick /dev/shm for a job's files if it has room on top of the other jobs there, else disk."""
+    global _shm_reserved
+    try:
+        free = shutil.disk_usage(SHM_JOB_DIR).free
+    except OSError:
+        return TEMP_DOWNLOAD_DIR
+    # Free space already excludes whatever the other jobs have written, so
+    # counting their full reservation as well errs on the side of disk
+    if free - _shm_reserved <= nbytes:
+        return TEMP_DOWNLOAD_DIR
+    _shm_reserved += nbytes
+    return SHM_JOB_DIR
+
 
+def release_job_dir(job_dir: Optional[str], nbytes: int) -> None:
+    """Give back the /dev/shm space reserve_job_dir() promised to a finished job."""
+    global _shm_reserved
+    if job_dir == SHM_JOB_DIR:
+        _shm_reserved -= nbytes
 
-async def process_compression(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+
+def remove_files(*paths: Optional[str]) -> None:
+    """Delete temporary files, ignoring ones that were never named or created."""
+    for path in paths:
+        if path is None:
+            continue
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+
+
+async def process_compression(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                              task_info: Task) -> None:
     """Process video compression in the background."""
+    updater: Optional[StatusUpdater] = None
+    # Set once a worker picks the job up, see claim_job_files()
+    job_dir: Optional[str] = None
+    input_path: Optional[str] = None
+    output_path: Optional[str] = None
+    # A job holds its input and output at the same time
+    job_bytes = 2 * task_info.video_info["file_size"]
     try:
-        task_info = active_tasks[user_id]
-        video_info = task_info["video_info"]
-        quality = task_info["quality"]
-        status_message_id = task_info["status_message_id"]
+        video_info = task_info.video_info
+        quality = task_info.quality
+        codec = task_info.codec
+        status_message_id = task_info.status_message_id
+        # Sizes are formatted once per job from these values. This path is
+        # network- and disk-bound, so a JIT (e.g. Numba) would spend more on
+        # warm-up than the handful of scalar operations it could speed up.
+        orig_mb = f"{video_info['file_size'] / (1 << 20):.1f}"
+        updater = StatusUpdater(context.bot, update.effective_chat.id, status_message_id)
         
-        # Update status message
-        await context.bot.edit_message_text(
-            f"⬇️ Downloading video...\n\n"
-            f"Original size: {video_info['file_size']/(1024*1024):.1f}MB\n"
-            f"Quality preset: *{quality.capitalize()}*",
-            chat_id=update.effective_chat.id,
-            message_id=status_message_id,
-            parse_mode="Markdown"
-        )
-        
-        # Download video file
-        video_file = await context.bot.get_file(video_info["file_id"])
-        
-        # Create unique filename
-        input_path = os.path.join(TEMP_DOWNLOAD_DIR, f"input_{user_id}_{int(time.time())}_{video_info['file_name']}")
-        output_path = os.path.join(TEMP_DOWNLOAD_DIR, f"output_{user_id}_{int(time.time())}_{video_info['file_name']}")
-        
-        # Download the file
-        await video_file.download_to_drive(input_path)
-        
-        # Check for cancellation
-        if active_tasks[user_id]["canceled"]:
-            os.remove(input_path)
-            await context.bot.edit_message_text(
-                "❌ Compression canceled.",
-                chat_id=update.effective_chat.id,
-                message_id=status_message_id
-            )
-            del active_tasks[user_id]
-            return
+        # Name the job's files; uuid4 keeps them apart however close together
+        # a user's jobs were started
+        job_id = f"{user_id}_{uuid4().hex}"
+        # Every encoder path writes MP4, whatever container the upload used
+        output_name = f"{os.path.splitext(video_info['file_name'] or 'video')[0]}.mp4"
         
-        # Update status message
-        await context.bot.edit_message_text(
-            f"🔄 Compressing video...\n\n"
-            f"Quality preset: *{quality.capitalize()}*\n"
-            f"({COMPRESSION_PRESETS[quality]['description']})\n\n"
-            f"This may take several minutes for larger videos.",
-            chat_id=update.effective_chat.id,
-            message_id=status_message_id,
-            parse_mode="Markdown"
-        )
+        def claim_job_files() -> None:
+            """Place the job's files in /dev/shm if it has room right now, else on disk."""
+            nonlocal job_dir, input_path, output_path
+            job_dir = reserve_job_dir(job_bytes)
+            input_path = os.path.join(job_dir, f"input_{job_id}_{video_info['file_name']}")
+            output_path = os.path.join(job_dir, f"output_{job_id}_{output_name}")
         
         # Get compression settings
         preset = COMPRESSION_PRESETS[quality]
         
-        # Run compression in a separate thread to avoid blocking
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(
-            None,
-            partial(compress_video, input_path, output_path, preset)
-        )
+        async def run_job() -> None:
+            # /cancel may have arrived while the job was queued
+            if task_info.canceled:
+                return
+            
+            # Resolve the file through the Bot API unless MTProto will fetch it.
+            # The link expires after about an hour, so it is only fetched once
+            # a worker picks the job up.
+            video_file = None if pyro_client is not None else await context.bot.get_file(video_info["file_id"])
+            if task_info.canceled:
+                return
+            claim_job_files()
+            
+            if video_file is not None and can_stream(video_info, video_file):
+                # Update status message
+                updater.set(
+                    f"🔄 Downloading and compressing video...\n\n"
+                    f"Quality preset: *{quality.capitalize()}*\n"
+                    f"({preset['description']})\n\n"
+                    f"This may take several minutes for larger videos.",
+                    parse_mode="Markdown"
+                )
+                
+                # Pipe the download into ffmpeg without writing the input to disk
+                await stream_compress_video(video_file.file_path, output_path, quality, codec, task_info)
+                return
+            
+            # Download only now, so queued jobs don't each hold a full input
+            # file in the job directory
+            updater.set(
+                f"⬇️ Downloading video...\n\n"
+                f"Original size: {orig_mb}MB\n"
+                f"Quality preset: *{quality.capitalize()}*",
+                parse_mode="Markdown"
+            )
+            if pyro_client is not None:
+                # MTProto fetches the file in parallel chunks with no 20MB cap
+                await pyro_client.download_media(video_info["file_id"], file_name=input_path)
+            else:
+                await download_file(video_file, input_path)
+            
+            # /cancel may have arrived during the download
+            if task_info.canceled:
+                return
+            
+            # Update status message
+            updater.set(
+                f"🔄 Compressing video...\n\n"
+                f"Quality preset: *{quality.capitalize()}*\n"
+                f"({preset['description']})\n\n"
+                f"This may take several minutes for larger videos.",
+                parse_mode="Markdown"
+            )
+            
+            # Run ffmpeg as a child process without tying up an executor thread
+            await compress_video(input_path, output_path, quality, codec, task_info)
         
-        # Check for cancellation
-        if active_tasks[user_id]["canceled"]:
-            # Clean up files
-            for file_path in [input_path, output_path]:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    
-            await context.bot.edit_message_text(
-                "❌ Compression canceled.",
-                chat_id=update.effective_chat.id,
-                message_id=status_message_id
+        # Tell the user where the job stands when every encoder is busy
+        position = ffmpeg_pool.position()
+        if position:
+            updater.set(
+                f"⏳ Waiting for a free encoder...\n\n"
+                f"Position in queue: {position}\n"
+                f"Quality preset: *{quality.capitalize()}*",
+                parse_mode="Markdown"
             )
-            del active_tasks[user_id]
+        await ffmpeg_pool.submit(run_job)
+        
+        # Check for cancellation (files are removed in the finally block)
+        if task_info.canceled:
+            updater.set("❌ Compression canceled.")
             return
         
         # Get compressed file size
         output_size = os.path.getsize(output_path)
-        size_reduction = 100 - (output_size / video_info["file_size"] * 100)
+        output_mb = f"{output_size / (1 << 20):.1f}"
+        size_reduction = 100 - output_size * 100 // video_info["file_size"]
         
         # Update status message
-        await context.bot.edit_message_text(
+        updater.set(
             f"⬆️ Uploading compressed video...\n\n"
-            f"Original size: {video_info['file_size']/(1024*1024):.1f}MB\n"
-            f"Compressed size: {output_size/(1024*1024):.1f}MB\n"
-            f"Reduction: {size_reduction:.1f}%",
-            chat_id=update.effective_chat.id,
-            message_id=status_message_id,
+            f"Original size: {orig_mb}MB\n"
+            f"Compressed size: {output_mb}MB\n"
+            f"Reduction: {size_reduction}%",
             parse_mode="Markdown"
         )
         
+        caption = (
+            f"✅ Video compressed successfully!\n\n"
+            f"Quality preset: *{quality.capitalize()}*\n"
+            f"Codec: {CODEC_LABELS[codec]}\n"
+            f"Original size: {orig_mb}MB\n"
+            f"Compressed size: {output_mb}MB\n"
+            f"Space saved: {size_reduction}%"
+        )
+        
         # Send the compressed video back to the user
-        with open(output_path, "rb") as video_file:
-            await context.bot.send_video(
-                chat_id=update.effective_chat.id,
-                video=video_file,
-                caption=f"✅ Video compressed successfully!\n\n"
-                        f"Quality preset: *{quality.capitalize()}*\n"
-                        f"Original size: {video_info['file_size']/(1024*1024):.1f}MB\n"
-                        f"Compressed size: {output_size/(1024*1024):.1f}MB\n"
-                        f"Space saved: {size_reduction:.1f}%",
-                parse_mode="Markdown",
+        if pyro_client is not None and output_size > BOT_API_UPLOAD_LIMIT:
+            # The Bot API rejects larger uploads; Pyrogram's Markdown marks
+            # bold with double asterisks
+            await pyro_client.send_video(
+                update.effective_chat.id,
+                output_path,
+                caption=caption.replace("*", "**"),
                 supports_streaming=True,
-                filename=f"compressed_{video_info['file_name']}"
+                file_name=f"compressed_{output_name}"
+            )
+        else:
+            # Stream the file from disk instead of loading it into memory
+            await upload_video(
+                context.bot,
+                update.effective_chat.id,
+                output_path,
+                caption,
+                f"compressed_{output_name}"
             )
         
         # Clean up the status message
-        await context.bot.edit_message_text(
+        updater.set(
             f"✅ Compression completed!\n\n"
             f"Quality preset: *{quality.capitalize()}*\n"
-            f"Original size: {video_info['file_size']/(1024*1024):.1f}MB\n"
-            f"Compressed size: {output_size/(1024*1024):.1f}MB\n"
-            f"Reduction: {size_reduction:.1f}%\n\n"
+            f"Original size: {orig_mb}MB\n"
+            f"Compressed size: {output_mb}MB\n"
+            f"Reduction: {size_reduction}%\n\n"
             f"Send another video to compress again.",
-            chat_id=update.effective_chat.id,
-            message_id=status_message_id,
             parse_mode="Markdown"
         )
     
     except Exception as e:
         logger.error(f"Error during compression: {e}")
         try:
-            await context.bot.edit_message_text(
-                f"❌ An error occurred during compression:\n{str(e)}\n\nPlease try again later.",
-                chat_id=update.effective_chat.id,
-                message_id=status_message_id
+            updater.set(
+                f"❌ An error occurred during compression:\n{str(e)}\n\nPlease try again later."
             )
         except Exception:
             pass
     
     finally:
-        # Clean up
+        # Let the last status edit land before the task goes away
+        if updater is not None:
+            await updater.flush()
+        
+        # Clean up off the event loop
         try:
-            for file_path in [input_path, output_path]:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+            await asyncio.to_thread(remove_files, input_path, output_path)
         except Exception as e:
             logger.error(f"Error cleaning up files: {e}")
+        release_job_dir(job_dir, job_bytes)
         
         # Remove task from active tasks
-        if user_id in active_tasks:
-            del active_tasks[user_id]
+        user_tasks = active_tasks.get(user_id, [])
+        if task_info in user_tasks:
+            user_tasks.remove(task_info)
+        if not user_tasks:
+            active_tasks.pop(user_id, None)
 
 
-def compress_video(input_path: str, output_path: str, preset: Dict[str, Any]) -> None:
-    """Compress video using ffmpeg."""
+async def _run_ffmpeg_probe(*args: str, timeout: float) -> Tuple[int, bytes]:
+    """Run a short ffmpeg command and return its exit code and stdout (-1 on timeout)."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
     try:
-        # Create the ffmpeg process
-        (
-            ffmpeg
-            .input(input_path)
-            .output(
-                output_path,
-                vcodec='libx264',
-                crf=preset["crf"],
-                preset=preset["preset"],
-                acodec='aac',
-                audio_bitrate='128k',
-                **{'-movflags': '+faststart'}
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        # A broken driver can hang a test encode; don't let it hold up startup
+        logger.warning(f"ffmpeg {' '.join(args)} timed out after {timeout}s")
+        proc.kill()
+        await proc.wait()
+        return -1, b""
+    return proc.returncode, stdout
+
+
+def _parse_codec_listing(stdout: bytes) -> Set[str]:
+    """Extract codec names from `ffmpeg -encoders` / `ffmpeg -decoders` output."""
+    # Codec rows follow the " ------" separator as "<flags> <name> <description>"
+    listing = stdout.decode(errors="replace").split(" ------", 1)[-1]
+    return {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+
+
+async def probe_codecs() -> None:
+    """Detect the usable ffmpeg encoders and decoders once and cache them."""
+    global AVAILABLE_ENCODERS, AVAILABLE_DECODERS
+    try:
+        _, encoder_listing = await _run_ffmpeg_probe("-encoders", timeout=10)
+        _, decoder_listing = await _run_ffmpeg_probe("-decoders", timeout=10)
+    except OSError as e:
+        logger.warning(f"Codec probe failed: {e}")
+        return
+    
+    encoders = _parse_codec_listing(encoder_listing)
+    AVAILABLE_DECODERS = frozenset(_parse_codec_listing(decoder_listing))
+    
+    # Builds list hardware encoders whether or not the device exists,
+    # so each candidate must also pass a one-frame test encode.
+    has_render_node = os.path.exists(VAAPI_DEVICE)
+    candidates = []
+    for codec in CODEC_LABELS:
+        candidates += [
+            (f"{codec}_nvenc", True, [], ["-c:v", f"{codec}_nvenc"]),
+            (f"{codec}_qsv", has_render_node, [], ["-pix_fmt", "nv12", "-c:v", f"{codec}_qsv"]),
+            (f"{codec}_vaapi", has_render_node, ["-vaapi_device", VAAPI_DEVICE],
+             ["-vf", "format=nv12,hwupload", "-c:v", f"{codec}_vaapi"]),
+        ]
+    for name, device_present, input_args, output_args in candidates:
+        if name not in encoders:
+            continue
+        returncode = -1
+        if device_present:
+            returncode, _ = await _run_ffmpeg_probe(
+                "-loglevel", "error", *input_args,
+                "-f", "lavfi", "-i", "nullsrc=s=256x256", "-frames:v", "1",
+                *output_args, "-f", "null", "-",
+                timeout=30
+            )
+        if returncode != 0:
+            encoders.discard(name)
+    
+    AVAILABLE_ENCODERS = frozenset(encoders)
+    for codec, label in CODEC_LABELS.items():
+        if resolve_codec(codec) == codec:
+            logger.info(f"Using {select_encoder(codec)} encoder for {label}")
+
+
+def select_encoder(codec: str = "h264") -> str:
+    """Pick the fastest usable encoder for a codec: NVENC, then QSV, then VAAPI, then software."""
+    for backend in HARDWARE_BACKENDS:
+        if ENCODER_NAMES[(backend, codec)] in AVAILABLE_ENCODERS:
+            return backend
+    return "software"
+
+
+def resolve_codec(codec: str) -> str:
+    """Fall back to H.264 when nothing on this host can encode the requested codec."""
+    if codec != "h264" and not any(
+        ENCODER_NAMES[(backend, codec)] in AVAILABLE_ENCODERS
+        for backend in (*HARDWARE_BACKENDS, "software")
+    ):
+        return "h264"
+    return codec
+
+
+async def probe_gpus() -> None:
+    """Count the NVIDIA GPUs that NVENC jobs can be spread across."""
+    global NVIDIA_GPU_COUNT, _gpu_jobs
+    if select_encoder() != "nvenc" or shutil.which("nvidia-smi") is None:
+        return
+    proc = await asyncio.create_subprocess_exec(
+        "nvidia-smi", "-L",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await proc.communicate()
+    gpus = [line for line in stdout.decode(errors="replace").splitlines() if line.startswith("GPU ")]
+    NVIDIA_GPU_COUNT = max(1, len(gpus))
+    _gpu_jobs = [0] * NVIDIA_GPU_COUNT
+    logger.info(f"Spreading NVENC jobs across {NVIDIA_GPU_COUNT} GPU(s)")
+
+
+class FfmpegWorkerPool:
+    """Fixed set of workers that run ffmpeg jobs from a shared FIFO queue."""
+    
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        self.idle = 0
+    
+    def start(self) -> None:
+        """Start the worker tasks."""
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.size)]
+    
+    async def stop(self) -> None:
+        """Stop the worker tasks; queued jobs are dropped."""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+    
+    def position(self) -> int:
+        """Queue position a job submitted now would get; 0 if a worker is free."""
+        return max(0, self.queue.qsize() - self.idle + 1)
+    
+    async def submit(self, job: Callable[[], Awaitable[None]]) -> None:
+        """Queue a job and wait until a worker has run it."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future))
+        await future
+    
+    async def _work(self) -> None:
+        """Run queued jobs one at a time, forwarding results to their submitters."""
+        while True:
+            self.idle += 1
+            try:
+                job, future = await self.queue.get()
+            finally:
+                self.idle -= 1
+            try:
+                # Skip jobs whose submitter stopped waiting while they were queued
+                if not future.done():
+                    await job()
+                    if not future.done():
+                        future.set_result(None)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+
+def pool_size() -> int:
+    """Number of ffmpeg jobs to run at once for the selected encoder."""
+    if select_encoder() == "nvenc":
+        return MAX_CONCURRENT_NVENC * NVIDIA_GPU_COUNT
+    return os.cpu_count() or 1
+
+
+@contextmanager
+def ffmpeg_env(codec: str) -> Iterator[Optional[Dict[str, str]]]:
+    """Pin an NVENC job to the least-busy GPU until it exits; None keeps the inherited env."""
+    if select_encoder(codec) != "nvenc" or NVIDIA_GPU_COUNT < 2:
+        yield None
+        return
+    # The pool runs MAX_CONCURRENT_NVENC jobs per GPU, so the least-busy
+    # GPU always has a free session
+    gpu = min(range(NVIDIA_GPU_COUNT), key=_gpu_jobs.__getitem__)
+    _gpu_jobs[gpu] += 1
+    try:
+        yield {**os.environ, "CUDA_VISIBLE_DEVICES": str(gpu)}
+    finally:
+        _gpu_jobs[gpu] -= 1
+
+
+def build_argv_table() -> None:
+    """Pre-build the ffmpeg options for every (quality, encoder, codec) combination."""
+    # Fragmented MP4 puts the moov box up front in a single write pass, unlike
+    # +faststart which rewrites the whole file after encoding to relocate it
+    # -f mp4 keeps ffmpeg from picking the muxer from the output name
+    common_args = (
+        "-c:a", "aac", "-b:a", "128k",
+        "-f", "mp4", "-movflags", "+frag_keyframe+empty_moov+default_base_moof"
+    )
+    # Apple players only accept HEVC in MP4 under the hvc1 sample entry
+    codec_args = {"h264": (), "hevc": ("-tag:v", "hvc1")}
+    for quality, preset in COMPRESSION_PRESETS.items():
+        crf = str(preset["crf"])
+        for codec, extra_args in codec_args.items():
+            output_args = (*extra_args, *common_args)
+            # NVENC decode options depend on the source stream, see nvdec_args()
+            PRECOMPUTED_ARGV[(quality, "nvenc", codec)] = (
+                (),
+                ("-c:v", f"{codec}_nvenc", "-preset", preset["nvenc_preset"], "-tune", "hq",
+                 "-rc", "vbr", "-cq", crf, *output_args),
+            )
+            PRECOMPUTED_ARGV[(quality, "qsv", codec)] = (
+                (),
+                ("-c:v", f"{codec}_qsv", "-preset", preset["preset"], "-global_quality", crf,
+                 "-pix_fmt", "nv12", *output_args),
+            )
+            PRECOMPUTED_ARGV[(quality, "vaapi", codec)] = (
+                ("-vaapi_device", VAAPI_DEVICE),
+                ("-vf", "format=nv12,hwupload", "-c:v", f"{codec}_vaapi", "-qp", crf, *output_args),
             )
-            .global_args('-y')  # Overwrite output file if it exists
-            .run(quiet=True, overwrite_output=True)
+        PRECOMPUTED_ARGV[(quality, "software", "h264")] = (
+            (),
+            ("-c:v", "libx264", "-preset", preset["preset"], "-crf", crf, *common_args),
         )
-    except ffmpeg.Error as e:
-        logger.error(f"FFmpeg error: {e.stderr.decode() if e.stderr else str(e)}")
-        raise Exception(f"Video compression failed: {e.stderr.decode() if e.stderr else str(e)}")
+        # x265 at CRF+5 looks about the same as x264 at CRF, at a smaller size
+        PRECOMPUTED_ARGV[(quality, "software", "hevc")] = (
+            (),
+            ("-c:v", "libx265", "-preset", preset["preset"], "-crf", str(preset["crf"] + 5),
+             *codec_args["hevc"], *common_args),
+        )
+
+
+def nvdec_args(codec: str, source_codec: Optional[str],
+               source_pix_fmt: Optional[str]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Pick decoder and pixel format options that keep frames in VRAM from NVDEC through NVENC."""
+    # Frames that reach NVENC from system memory are converted to 8-bit 4:2:0,
+    # which every NVENC generation can encode
+    software_frames = ("-pix_fmt", "yuv420p")
+    if source_codec is None:
+        # Unprobed (piped) input: let ffmpeg try NVDEC and fall back by itself
+        return ("-hwaccel", "cuda"), software_frames
+    decoder = NVDEC_DECODERS.get(source_codec)
+    if decoder is None or decoder not in AVAILABLE_DECODERS:
+        # No NVDEC support for this codec: decode in software, NVENC uploads frames
+        return (), software_frames
+    device_args = ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda", "-c:v", decoder)
+    if source_pix_fmt in NVENC_PIX_FMTS[codec]:
+        # Frames stay on the device; any scaling added later must use scale_cuda
+        return device_args, ()
+    if source_pix_fmt in NVDEC_10BIT_PIX_FMTS:
+        # 10-bit source for an 8-bit-only encoder: convert on the device
+        return device_args, ("-vf", "scale_cuda=format=nv12")
+    # 4:2:2, 4:4:4 or unknown layouts: NVDEC support varies, decode in software
+    return (), software_frames
+
+
+async def probe_video_stream(input_path: str) -> Tuple[Optional[str], Optional[str]]:
+    """Return the codec name and pixel format of the first video stream, None where unknown."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=codec_name,pix_fmt", "-of", "default=nw=1",
+            input_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+    except OSError as e:
+        logger.warning(f"ffprobe failed: {e}")
+        return None, None
+    # Output is one "key=value" line per requested field
+    fields = dict(
+        line.split("=", 1) for line in stdout.decode(errors="replace").splitlines() if "=" in line
+    )
+    return fields.get("codec_name") or None, fields.get("pix_fmt") or None
+
+
+def ffmpeg_argv(input_path: str, output_path: str, quality: str, codec: str,
+                source_codec: Optional[str] = None,
+                source_pix_fmt: Optional[str] = None) -> Tuple[str, ...]:
+    """Assemble the ffmpeg command line for a job from the pre-built options."""
+    encoder = select_encoder(codec)
+    input_args, output_args = PRECOMPUTED_ARGV[(quality, encoder, codec)]
+    if encoder == "nvenc":
+        input_args, format_args = nvdec_args(codec, source_codec, source_pix_fmt)
+        output_args = (*format_args, *output_args)
+    # Only errors reach stderr, so the captured output stays small, and
+    # -nostdin keeps ffmpeg from reading the bot's terminal for hotkeys
+    return (
+        "ffmpeg", "-hide_banner", "-nostdin", "-loglevel", "error", "-y",
+        *input_args, "-i", input_path, *output_args, output_path
+    )
+
+
+async def compress_video(input_path: str, output_path: str, quality: str, codec: str,
+                         task_info: Task) -> None:
+    """Compress video using an ffmpeg child process."""
+    # Only the NVENC path needs the source stream, to choose an NVDEC decoder
+    # and any pixel format conversion
+    source_codec, source_pix_fmt = (
+        await probe_video_stream(input_path) if select_encoder(codec) == "nvenc" else (None, None)
+    )
+    with ffmpeg_env(codec) as env:
+        proc = await asyncio.create_subprocess_exec(
+            *ffmpeg_argv(input_path, output_path, quality, codec, source_codec, source_pix_fmt),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            env=env
+        )
+        task_info.proc = proc
+        # /cancel may have arrived during the probe or the spawn, before
+        # there was a process for it to signal
+        if task_info.canceled:
+            proc.send_signal(signal.SIGTERM)
+        _, stderr = await proc.communicate()
+    check_ffmpeg_result(proc.returncode, stderr, task_info)
+
+
+def check_ffmpeg_result(returncode: int, stderr: bytes, task_info: Task) -> None:
+    """Raise if ffmpeg failed, unless it was stopped by /cancel."""
+    if returncode != 0 and not task_info.canceled:
+        error = stderr.decode(errors="replace")
+        logger.error(f"FFmpeg error: {error}")
+        raise Exception(f"Video compression failed: {error}")
+
+
+async def download_file(video_file: File, path: str) -> None:
+    """Download a Telegram file to disk in chunks without blocking the event loop."""
+    if not video_file.file_path.startswith(("http://", "https://")):
+        # Local Bot API server mode: the file is already on this machine
+        await video_file.download_to_drive(path)
+        return
+    
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=STREAM_READ_TIMEOUT)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(video_file.file_path) as response:
+                response.raise_for_status()
+                async with aiofiles.open(path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(FILE_CHUNK_SIZE):
+                        await f.write(chunk)
+    except asyncio.TimeoutError:
+        # str() of a timeout is empty, so say what happened for the status message
+        raise Exception("Video download timed out") from None
+
+
+async def iter_file_chunks(path: str) -> AsyncIterator[bytes]:
+    """Yield a file's contents in chunks read off the event loop."""
+    async with aiofiles.open(path, "rb") as f:
+        while chunk := await f.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+
+async def upload_video(bot: Bot, chat_id: int, path: str, caption: str, filename: str) -> None:
+    """Send a video through the Bot API, streaming the file from disk."""
+    # PTB reads the whole file into memory before sending; posting the
+    # multipart form with aiohttp keeps only one chunk resident at a time
+    form = aiohttp.FormData()
+    form.add_field("chat_id", str(chat_id))
+    form.add_field("caption", caption)
+    form.add_field("parse_mode", "Markdown")
+    form.add_field("supports_streaming", "true")
+    form.add_field("video", iter_file_chunks(path), filename=filename, content_type="video/mp4")
+    
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=UPLOAD_READ_TIMEOUT)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(f"{bot.base_url}/sendVideo", data=form) as response:
+                result = await response.json()
+    except asyncio.TimeoutError:
+        # str() of a timeout is empty, so say what happened for the status message
+        raise Exception("Video upload timed out") from None
+    if not result.get("ok"):
+        raise TelegramError(result.get("description", "sendVideo failed"))
+
+
+def can_stream(video_info: Dict[str, Any], video_file: File) -> bool:
+    """Check whether a video can be piped into ffmpeg while it downloads."""
+    return (
+        video_info["mime_type"] in STREAMABLE_MIME_TYPES
+        and video_file.file_path.startswith(("http://", "https://"))
+    )
+
+
+async def stream_compress_video(file_url: str, output_path: str, quality: str, codec: str,
+                                task_info: Task) -> None:
+    """Compress video using ffmpeg, feeding the download straight into its stdin."""
+    with ffmpeg_env(codec) as env:
+        proc = await asyncio.create_subprocess_exec(
+            *ffmpeg_argv("pipe:0", output_path, quality, codec),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            env=env
+        )
+        task_info.proc = proc
+        # /cancel may have arrived during the spawn, before there was a
+        # process for it to signal
+        if task_info.canceled:
+            proc.send_signal(signal.SIGTERM)
+        # Drain stderr concurrently so a chatty ffmpeg can't stall on a full pipe
+        stderr_task = asyncio.ensure_future(proc.stderr.read())
+        
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=STREAM_READ_TIMEOUT)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(file_url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early (failed or canceled); checked below
+            pass
+        except asyncio.TimeoutError:
+            # str() of a timeout is empty, so say what happened for the status message
+            proc.kill()
+            await proc.wait()
+            raise Exception("Video download timed out") from None
+        except BaseException:
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            proc.stdin.close()
+        
+        returncode = await proc.wait()
+    check_ffmpeg_result(returncode, await stderr_task, task_info)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -467,10 +1144,74 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         pass
 
 
+async def post_init(application: Application) -> None:
+    """Probe ffmpeg capabilities and start the workers and MTProto client before polling starts."""
+    global ffmpeg_pool, pyro_client
+    await probe_codecs()
+    await probe_gpus()
+    
+    ffmpeg_pool = FfmpegWorkerPool(pool_size())
+    ffmpeg_pool.start()
+    logger.info(f"Started {ffmpeg_pool.size} ffmpeg worker(s)")
+    
+    if PyrogramClient is not None and API_ID and API_HASH:
+        pyro_client = PyrogramClient(
+            ":memory:",
+            api_id=API_ID,
+            api_hash=API_HASH,
+            bot_token=TOKEN,
+            workdir=TEMP_DOWNLOAD_DIR
+        )
+        await pyro_client.start()
+        logger.info("MTProto client started for file transfers")
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop the ffmpeg workers and the MTProto client if they were started."""
+    if ffmpeg_pool is not None:
+        await ffmpeg_pool.stop()
+    if pyro_client is not None:
+        await pyro_client.stop()
+
+
+def setup_logging() -> None:
+    """Hand log records to a background thread so coroutines never block on log I/O."""
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(), logging.FileHandler(LOG_FILE)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    # Logging from the event loop is now just a put on the queue
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
 def main() -> None:
     """Start the bot."""
+    setup_logging()
+    
+    # Limit each ffmpeg's CUDA work queues before any child process is spawned
+    os.environ.setdefault("CUDA_DEVICE_MAX_CONNECTIONS", "2")
+    # Keep any scratch files ffmpeg creates on disk, outside the /dev/shm
+    # space reserved for job files
+    os.environ["TMPDIR"] = TEMP_DOWNLOAD_DIR
+    if os.path.isdir(SHM_JOB_DIR):
+        logger.info(f"Storing job files in {SHM_JOB_DIR} while it has room, else {TEMP_DOWNLOAD_DIR}")
+    else:
+        logger.info(f"Storing job files in {TEMP_DOWNLOAD_DIR}")
+    
+    # Pre-build the ffmpeg command lines used by every job
+    build_argv_table()
+    
     # Create the Application
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -480,6 +1221,7 @@ def main() -> None:
     
     # Add callback query handlers
     application.add_handler(CallbackQueryHandler(handle_settings_callback, pattern=r"^set_default_"))
+    application.add_handler(CallbackQueryHandler(handle_codec_callback, pattern=r"^set_codec_"))
     application.add_handler(CallbackQueryHandler(handle_compression_callback, pattern=r"^compress_"))
     
     # Add video handler